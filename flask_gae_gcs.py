@@ -13,11 +13,17 @@ import string
 import random
 import logging
 import os
+import time
+import shutil
+import threading
+from datetime import datetime, timedelta
+from tempfile import SpooledTemporaryFile
 from cgi import parse_header
-from StringIO import StringIO
+from collections import namedtuple
 
 import cloudstorage as gcs
-from flask import Response, request
+from flask import (Request, Response, request, json, current_app,
+                   has_request_context)
 from werkzeug.datastructures import FileStorage
 from functools import wraps
 from google.appengine.api import app_identity
@@ -25,9 +31,16 @@ from google.appengine.api import app_identity
 __all__ = [
     'WRITE_MAX_RETRIES', 'WRITE_SLEEP_SECONDS', 'DEFAULT_NAME_LEN',
     'MSG_INVALID_FILE_POSTED', 'UPLOAD_MIN_FILE_SIZE', 'UPLOAD_MAX_FILE_SIZE',
-    'UPLOAD_ACCEPT_FILE_TYPES', 'ORIGINS', 'OPTIONS', 'HEADERS', 'MIMETYPE',
-    'RemoteResponse', 'FileUploadResultSet', 'FileUploadResult',
-    'upload_files', 'save_files', 'write_to_gcs']
+    'UPLOAD_ACCEPT_FILE_TYPES', 'ORIGINS', 'OPTIONS', 'HEADERS',
+    'CORS_MAX_AGE', 'PREFLIGHT_METHODS', 'MIMETYPE',
+    'SPOOL_MAX_MEMORY_SIZE', 'WRITE_CHUNK_SIZE', 'EXPIRY_PREFIX',
+    'EXPIRY_PARTITION_FORMAT', 'EXPIRY_METADATA_KEY',
+    'FORCE_DOWNLOAD_METADATA_KEY', 'MSG_TOO_MANY_REQUESTS',
+    'UploadRequest', 'RemoteResponse', 'FileUploadResultSet',
+    'FileUploadResult', 'RateLimitBackend', 'MemoryRateLimitBackend',
+    'UploadAdmissionController', 'preflight_response', 'upload_files',
+    'save_files', 'write_to_gcs', 'delete_expired', 'copy_file',
+    'update_metadata']
 
 #:
 WRITE_MAX_RETRIES = 3
@@ -35,8 +48,25 @@ WRITE_MAX_RETRIES = 3
 WRITE_SLEEP_SECONDS = 0.05
 #:
 DEFAULT_NAME_LEN = 20
+#: Bytes read from an upload per write to Google Cloud Storage.
+WRITE_CHUNK_SIZE = 256 * 1024
+#: Default for GCS_SPOOL_MAX_MEMORY_SIZE, bytes of a posted file kept in
+#: memory before it is spooled to a temp file.
+SPOOL_MAX_MEMORY_SIZE = 512 * 1024
+#: Folder holding an empty marker object per expiring upload, partitioned
+#: by the hour the upload expires in.
+EXPIRY_PREFIX = '_expiry'
+#:
+EXPIRY_PARTITION_FORMAT = '%Y%m%d%H'
+#: Metadata key holding the unix timestamp an upload expires at.
+EXPIRY_METADATA_KEY = 'x-goog-meta-expires'
+#: Metadata key marking forced downloads, as `Content-Disposition` can't be
+#: read back with `gcs.stat`.
+FORCE_DOWNLOAD_METADATA_KEY = 'x-goog-meta-force-download'
 #:
 MSG_INVALID_FILE_POSTED = 'Invalid file posted.'
+#:
+MSG_TOO_MANY_REQUESTS = 'Too many uploads, retry later.'
 
 #:
 UPLOAD_MIN_FILE_SIZE = 1
@@ -46,17 +76,58 @@ UPLOAD_MAX_FILE_SIZE = 1024 * 1024
 #:
 UPLOAD_ACCEPT_FILE_TYPES = re.compile('image/(gif|p?jpeg|jpg|(x-)?png|tiff)')
 
-# todo: need a way to easily configure these values..
-#:
+# defaults for the GCS_CORS_ORIGINS, GCS_CORS_METHODS, GCS_CORS_HEADERS and
+# GCS_CORS_MAX_AGE app config values..
+#: String `'*'` or list of allowed origins.
 ORIGINS = '*'
 #:
 OPTIONS = ['OPTIONS', 'HEAD', 'GET', 'POST', 'PUT']
 #:
 HEADERS = ['Accept', 'Content-Type', 'Origin', 'X-Requested-With']
+#: Seconds browsers may cache a preflight response, None to omit.
+CORS_MAX_AGE = None
+#: Methods answered by `preflight_response` without reading the upload.
+PREFLIGHT_METHODS = ('OPTIONS', 'HEAD')
 #:
 MIMETYPE = 'application/json'
 
 
+class _SpooledPart(SpooledTemporaryFile):
+
+    '''Temp file kept in memory up to `max_size` bytes, counting the bytes
+    written to it as the part is parsed.
+    '''
+
+    def __init__(self, max_size):
+        SpooledTemporaryFile.__init__(self, max_size=max_size)
+        self.size = 0
+
+    def write(self, s):
+        self.size += len(s)
+        return SpooledTemporaryFile.write(self, s)
+
+
+def _spooled_part():
+    max_size = SPOOL_MAX_MEMORY_SIZE
+    if has_request_context():
+        max_size = current_app.config.get('GCS_SPOOL_MAX_MEMORY_SIZE',
+                                          max_size)
+    return _SpooledPart(max_size)
+
+
+class UploadRequest(Request):
+
+    '''`Request` that spools each posted file to a temp file once it grows
+    past GCS_SPOOL_MAX_MEMORY_SIZE, so `save_files` can stream it to Google
+    Cloud Storage without holding the whole body in memory. Set it as the
+    app's `request_class`.
+    '''
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        return _spooled_part()
+
+
 class RemoteResponse(Response):
 
     '''Base class for remote service `Response` objects.
@@ -73,9 +144,62 @@ class RemoteResponse(Response):
         self._fixcors()
 
     def _fixcors(self):
-        self.headers['Access-Control-Allow-Origin'] = ORIGINS
-        self.headers['Access-Control-Allow-Methods'] = ', '.join(OPTIONS)
-        self.headers['Access-Control-Allow-Headers'] = ', '.join(HEADERS)
+        cors = _cors_settings()
+        if isinstance(cors.origins, basestring):
+            self.headers['Access-Control-Allow-Origin'] = cors.origins
+        else:
+            origin = None
+            if has_request_context():
+                origin = request.headers.get('Origin')
+            if origin in cors.origins:
+                self.headers['Access-Control-Allow-Origin'] = origin
+            self.headers['Vary'] = 'Origin'
+        self.headers['Access-Control-Allow-Methods'] = cors.methods
+        self.headers['Access-Control-Allow-Headers'] = cors.headers
+
+
+_CorsSettings = namedtuple('_CorsSettings',
+                           ['origins', 'methods', 'headers', 'max_age'])
+
+
+def _build_cors_settings(config):
+    origins = config.get('GCS_CORS_ORIGINS', ORIGINS)
+    if not isinstance(origins, basestring):
+        origins = frozenset(origins)
+    max_age = config.get('GCS_CORS_MAX_AGE', CORS_MAX_AGE)
+    return _CorsSettings(
+        origins=origins,
+        methods=', '.join(config.get('GCS_CORS_METHODS', OPTIONS)),
+        headers=', '.join(config.get('GCS_CORS_HEADERS', HEADERS)),
+        max_age=str(max_age) if max_age is not None else None)
+
+
+def _cors_settings():
+    '''Returns the CORS header values for the current app, joined once on
+    first use and kept in `app.extensions`. Falls back to the module
+    defaults outside of an app context.
+    '''
+    try:
+        app = current_app._get_current_object()
+    except RuntimeError:
+        return _build_cors_settings({})
+    extension = app.extensions.setdefault('gae_gcs', {})
+    if 'cors' not in extension:
+        extension['cors'] = _build_cors_settings(app.config)
+    return extension['cors']
+
+
+def preflight_response():
+    '''Returns an empty `RemoteResponse` answering a CORS preflight, with
+    `Access-Control-Max-Age` set from `GCS_CORS_MAX_AGE`.
+
+      :returns: Instance of a `RemoteResponse`.
+    '''
+    response = RemoteResponse()
+    max_age = _cors_settings().max_age
+    if max_age is not None:
+        response.headers['Access-Control-Max-Age'] = max_age
+    return response
 
 
 class FileUploadResultSet(list):
@@ -132,13 +256,196 @@ class FileUploadResult:
         }
 
 
+class RateLimitBackend(object):
+
+    '''Interface for token bucket stores used by
+    `UploadAdmissionController`. Subclass and implement `consume` to share
+    limits between instances, e.g. on top of memcache or the datastore.
+    '''
+
+    def consume(self, key, rate, capacity, amount, force=False):
+        '''Takes `amount` tokens from the bucket stored under `key`.
+
+          :param key: String, bucket key.
+          :param rate: Float, tokens refilled per second.
+          :param capacity: Float, maximum tokens the bucket can hold.
+          :param amount: Float, tokens to take, a negative amount refunds
+                         tokens.
+          :param force: Boolean, take the tokens even if the bucket does not
+                        hold enough, leaving it in debt.
+
+          :returns: Float, seconds to wait before retrying, 0 if the tokens
+                    were taken.
+        '''
+        raise NotImplementedError
+
+
+class MemoryRateLimitBackend(RateLimitBackend):
+
+    '''Keeps token buckets in instance memory, so limits apply per
+    instance.
+
+      :param max_keys: Integer, number of buckets kept before buckets that
+                       have refilled to capacity are dropped.
+    '''
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._buckets = {}
+        # earliest time any stored bucket is back at capacity..
+        self._next_prune = float('inf')
+        self._lock = threading.Lock()
+
+    def consume(self, key, rate, capacity, amount, force=False):
+        with self._lock:
+            now = time.time()
+            tokens, stamp, _, _ = self._buckets.get(
+                key, (capacity, now, rate, capacity))
+            tokens = min(capacity, tokens + (now - stamp) * rate)
+            # an amount over capacity only needs a full bucket to pass..
+            needed = min(amount, capacity)
+            if tokens < needed and not force:
+                self._store(key, tokens, now, rate, capacity)
+                return (needed - tokens) / rate
+            self._store(key, tokens - amount, now, rate, capacity)
+            if (len(self._buckets) > self.max_keys and
+                    now >= self._next_prune):
+                self._prune(now)
+            return 0
+
+    def _store(self, key, tokens, stamp, rate, capacity):
+        self._buckets[key] = (tokens, stamp, rate, capacity)
+        self._next_prune = min(self._next_prune,
+                               stamp + (capacity - tokens) / rate)
+
+    def _prune(self, now):
+        self._next_prune = float('inf')
+        for key, (tokens, stamp, rate, capacity) in self._buckets.items():
+            full_at = stamp + (capacity - tokens) / rate
+            if full_at <= now:
+                del self._buckets[key]
+            else:
+                self._next_prune = min(self._next_prune, full_at)
+
+
+class UploadAdmissionController(object):
+
+    '''Decides whether an upload request is accepted before its body is
+    read. Rejected requests get a 429 `RemoteResponse` and are not charged
+    against the client's limits.
+
+      :param bytes_per_second: Integer, sustained upload bytes per client.
+      :param bytes_burst: Integer, bytes a client may send at once, defaults
+                          to `UPLOAD_MAX_FILE_SIZE` or `bytes_per_second`,
+                          whichever is larger.
+      :param files_per_minute: Integer, sustained files per client.
+      :param files_burst: Integer, files a client may send at once, defaults
+                          to `files_per_minute`.
+      :param max_concurrent: Integer, uploads in flight on this instance.
+      :param key_func: Callable returning the client key for the current
+                       request, defaults to the remote address.
+      :param backend: Instance of a `RateLimitBackend`, defaults to
+                      `MemoryRateLimitBackend`.
+    '''
+
+    def __init__(self, bytes_per_second=None, bytes_burst=None,
+                 files_per_minute=None, files_burst=None,
+                 max_concurrent=None, key_func=None, backend=None):
+        self.bytes_per_second = bytes_per_second
+        self.bytes_burst = bytes_burst or max(bytes_per_second or 0,
+                                              UPLOAD_MAX_FILE_SIZE)
+        self.files_per_minute = files_per_minute
+        self.files_burst = files_burst or files_per_minute
+        self.max_concurrent = max_concurrent
+        self.key_func = key_func or (lambda: request.remote_addr)
+        self.backend = backend or MemoryRateLimitBackend()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def admit(self):
+        '''Admits the current request, to be paired with `release`.
+
+          :returns: None if admitted, otherwise a `RemoteResponse`.
+        '''
+        key = self.key_func()
+        if not self._acquire():
+            return self._reject(key, 1)
+        charges = []
+        if self.bytes_per_second:
+            size = request.content_length
+            if size is None:
+                # chunked bodies don't announce their size, charge a burst..
+                size = self.bytes_burst
+            charges.append(('bytes:%s' % key, self.bytes_per_second,
+                            self.bytes_burst, size))
+        if self.files_per_minute:
+            # the file count is unknown until the body is parsed, so only
+            # require one file worth of tokens here, see `record_files`..
+            charges.append(('files:%s' % key, self.files_per_minute / 60.0,
+                            self.files_burst, 1))
+        retry_after = 0
+        try:
+            for i, (bucket, rate, capacity, amount) in enumerate(charges):
+                retry_after = self.backend.consume(bucket, rate, capacity,
+                                                   amount)
+                if retry_after:
+                    # refund the buckets already charged..
+                    for charged, rate, capacity, amount in charges[:i]:
+                        self.backend.consume(charged, rate, capacity,
+                                             -amount, force=True)
+                    break
+        except Exception:
+            # a failing shared store must not leak the in-flight slot..
+            self.release()
+            raise
+        if retry_after:
+            self.release()
+            return self._reject(key, retry_after)
+        return None
+
+    def record_files(self, count):
+        '''Charges the files parsed from an admitted request beyond the one
+        taken by `admit`.
+
+          :param count: Integer, number of files posted.
+        '''
+        if self.files_per_minute and count > 1:
+            self.backend.consume(
+                'files:%s' % self.key_func(), self.files_per_minute / 60.0,
+                self.files_burst, count - 1, force=True)
+
+    def release(self):
+        '''Releases the in-flight slot taken by `admit`.'''
+        if self.max_concurrent:
+            with self._lock:
+                self._in_flight -= 1
+
+    def _acquire(self):
+        if not self.max_concurrent:
+            return True
+        with self._lock:
+            if self._in_flight >= self.max_concurrent:
+                return False
+            self._in_flight += 1
+            return True
+
+    def _reject(self, key, retry_after):
+        logging.warn('Upload from %s rejected, retry in %.1fs',
+                     key, retry_after)
+        response = RemoteResponse(
+            json.dumps({'error_msg': MSG_TOO_MANY_REQUESTS}), status=429)
+        response.headers['Retry-After'] = str(int(retry_after) + 1)
+        return response
+
+
 def get_gcs_filename(filename, bucket_name=None):
     if bucket_name:
         return '/' + bucket_name + '/' + filename
     return '/' + app_identity.get_default_gcs_bucket_name() + '/' + filename
 
 
-def upload_files(validators=None, retry_params=None, bucket_name=None):
+def upload_files(validators=None, retry_params=None, bucket_name=None,
+                 admission=None, expires_in=None):
     '''Method decorator for writing posted files to Google Cloud Storage using
     the App Engine CloudStorage api. Passes an argument to the method with a
     list of `FileUploadResult` with UUID, name, type, size for each posted
@@ -147,34 +454,60 @@ def upload_files(validators=None, retry_params=None, bucket_name=None):
       :param validators: List of callable objects.
       :param retry_params: `RetryParams` object from `cloudstorage`
       :param bucket_name: String of custom bucket name.
+      :param admission: `UploadAdmissionController` deciding whether the
+                        request is accepted before its body is read.
+      :param expires_in: Seconds or `timedelta` after which the uploads are
+                         removed by `delete_expired`.
+
+    `PREFLIGHT_METHODS` requests are answered by `preflight_response`
+    without calling the decorated method.
     '''
     def wrapper(fn):
         @wraps(fn)
         def decorated(*args, **kw):
-            return fn(
-                uploads=save_files(
-                    fields=_upload_fields(),
-                    validators=validators,
-                    retry_params=retry_params,
-                    bucket_name=bucket_name
-                ),
-                *args, **kw
-            )
+            if request.method in PREFLIGHT_METHODS:
+                return preflight_response()
+            if admission is not None:
+                rejected = admission.admit()
+                if rejected is not None:
+                    return rejected
+            try:
+                fields = _upload_fields()
+                if admission is not None:
+                    admission.record_files(len(fields))
+                return fn(
+                    uploads=save_files(
+                        fields=fields,
+                        validators=validators,
+                        retry_params=retry_params,
+                        bucket_name=bucket_name,
+                        expires_in=expires_in
+                    ),
+                    *args, **kw
+                )
+            finally:
+                if admission is not None:
+                    admission.release()
         return decorated
     return wrapper
 
 
-def save_files(fields, validators=None, retry_params=None, bucket_name=None):
+def save_files(fields, validators=None, retry_params=None, bucket_name=None,
+               expires_in=None):
     '''Returns a list of `FileUploadResult` with UUID, name, type, size for
     each posted file.
 
-      :param fields: List of `werkzeug.datastructures.FileStorage` objects.
+      :param fields: List of `werkzeug.datastructures.FileStorage` objects,
+                     their streams are written as they are, without
+                     being read into memory first.
       :param validators: List of functions, usually one of validate_min_size,
                          validate_file_type, validate_max_size included here.
                          By default validate_min_size is included to make sure
                          the file is not empty (see UPLOAD_MIN_FILE_SIZE).
       :param retry_params: `RetryParams` object from `cloudstorage`
       :param bucket_name: String of custom bucket name.
+      :param expires_in: Seconds or `timedelta` after which the files are
+                         removed by `delete_expired`.
 
       :returns: Instance of a `FileUploadResultSet`.
     '''
@@ -185,43 +518,55 @@ def save_files(fields, validators=None, retry_params=None, bucket_name=None):
         ]
     results = FileUploadResultSet()
     for name, field in fields:
-        value = field.stream.read()
+        value, size = _sized_stream(field.stream)
         filename = re.sub(r'^.*\\', '', field.filename)
         result = FileUploadResult(
             name=filename,
             type=field.mimetype,
-            size=len(value),
+            size=size,
             field=field,
             value=value,
             bucket_name=bucket_name if bucket_name else None)
-        if validators:
-            for fn in validators:
-                if not fn(result):
-                    result.successful = False
-                    result.error_msg = MSG_INVALID_FILE_POSTED
-                    logging.warn('Error in file upload: %s', result.error_msg)
-                else:
-                    result.uuid = write_to_gcs(
-                        result.value, mime_type=result.type, name=result.name,
-                        retry_params=retry_params, bucket_name=bucket_name)
-                    if result.uuid:
-                        result.successful = True
-                    else:
-                        result.successful = False
-            results.append(result)
-        else:
+        valid = True
+        for fn in validators or []:
+            if not fn(result):
+                valid = False
+                result.error_msg = MSG_INVALID_FILE_POSTED
+                logging.warn('Error in file upload: %s', result.error_msg)
+        if valid:
+            # written once, after every validator passed, as the stream can
+            # only be read through once..
+            result.value.seek(0)
             result.uuid = write_to_gcs(
                 result.value, mime_type=result.type, name=result.name,
-                retry_params=retry_params, bucket_name=bucket_name)
-            logging.error('result.uuid: %s', result.uuid)
-            if result.uuid:
-                result.successful = True
-            else:
-                result.successful = False
-            results.append(result)
+                retry_params=retry_params, bucket_name=bucket_name,
+                expires_in=expires_in)
+        result.successful = bool(result.uuid)
+        results.append(result)
     return results
 
 
+def _sized_stream(stream):
+    '''Returns the stream positioned at its start along with its size,
+    spooling streams that can't seek to a temp file first.
+    '''
+    # parts spooled by `UploadRequest` already know their size..
+    size = getattr(stream, 'size', None)
+    if size is not None:
+        stream.seek(0)
+        return stream, size
+    try:
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        stream.seek(0)
+        return stream, size
+    except (AttributeError, IOError, ValueError):
+        spooled = _spooled_part()
+        shutil.copyfileobj(stream, spooled, WRITE_CHUNK_SIZE)
+        spooled.seek(0)
+        return spooled, spooled.size
+
+
 def _upload_fields():
     '''Gets a list of files from the request.
     Uses Flask's request.files to get all files, unless the Content-Type is
@@ -243,7 +588,10 @@ def _upload_fields():
             request.headers.get('content-disposition', '')
         )
         filename = params.get('filename', 'noname.txt')
-        fileo = FileStorage(stream=StringIO(request.data),
+        stream = _spooled_part()
+        shutil.copyfileobj(request.stream, stream, WRITE_CHUNK_SIZE)
+        stream.seek(0)
+        fileo = FileStorage(stream=stream,
                             filename=filename,
                             content_type=request.headers.get('content-type'))
         result.append(('file', fileo))
@@ -310,18 +658,51 @@ def validate_file_type(result, accept_file_types=UPLOAD_ACCEPT_FILE_TYPES):
     return True
 
 
+def _retry_params(retry_params=None):
+    if retry_params:
+        return retry_params
+    return gcs.RetryParams(initial_delay=0.2,
+                           max_delay=5.0,
+                           backoff_factor=2,
+                           max_retry_period=15)
+
+
+def _expiry_partition(timestamp):
+    return datetime.utcfromtimestamp(timestamp).strftime(
+        EXPIRY_PARTITION_FORMAT)
+
+
+def _gcs_options(name, force_download):
+    if isinstance(name, unicode):
+        name = name.encode('ascii', errors='replace')
+
+    options = {}
+    if name:
+        options.update({b'x-goog-meta-filename': name})
+
+    if force_download:
+        options.update({
+            b'Content-Disposition': 'attachment; filename={}'.format(name),
+            FORCE_DOWNLOAD_METADATA_KEY: 'true'
+        })
+    return options
+
+
 def write_to_gcs(data, mime_type, name=None, retry_params=None,
-                 bucket_name=None, force_download=False):
+                 bucket_name=None, force_download=False, expires_in=None):
     '''Writes a file to Google Cloud Storage and returns the file name
     if successful.
 
-      :param data: Data to be stored.
+      :param data: Data to be stored, a string or a file-like object which
+                   is read in chunks of `WRITE_CHUNK_SIZE`.
       :param mime_type: String, mime type of the data.
       :param name: String, name of the data.
       :param retry_params: `RetryParams` object from `cloudstorage`
       :param bucket_name: String of custom bucket name.
       :param force_download: Boolean, whether or not file will be a forced
                              download
+      :param expires_in: Seconds or `timedelta` after which the file is
+                         removed by `delete_expired`.
 
       :returns: String, filename.
     '''
@@ -332,31 +713,160 @@ def write_to_gcs(data, mime_type, name=None, retry_params=None,
     new_uuid = str(uuid.uuid4())
     bucket_filename = get_gcs_filename(new_uuid, bucket_name)
 
-    if retry_params:
-        default_retry_params = retry_params
-    else:
-        default_retry_params = gcs.RetryParams(initial_delay=0.2,
-                                               max_delay=5.0,
-                                               backoff_factor=2,
-                                               max_retry_period=15)
-    if isinstance(name, unicode):
-        name = name.encode('ascii', errors='replace')
-
-    options = {}
-    if name:
-        options.update({b'x-goog-meta-filename': name})
-
-    if force_download:
-        options.update({
-            b'Content-Disposition': 'attachment; filename={}'.format(name)
-        })
+    default_retry_params = _retry_params(retry_params)
+    options = _gcs_options(name, force_download)
+
+    if expires_in is not None:
+        if isinstance(expires_in, timedelta):
+            expires_in = expires_in.total_seconds()
+        expires_at = int(time.time() + expires_in)
+        options.update({EXPIRY_METADATA_KEY: str(expires_at)})
+        # the marker goes first, so a failed write can't leave behind a
+        # file that is never cleaned up..
+        marker = gcs.open(
+            get_gcs_filename('/'.join([EXPIRY_PREFIX,
+                                       _expiry_partition(expires_at),
+                                       new_uuid]), bucket_name),
+            'w',
+            retry_params=default_retry_params)
+        marker.close()
 
     gcs_file = gcs.open(bucket_filename,
                         'w',
                         content_type=mime_type,
                         options=options,
                         retry_params=default_retry_params)
-    gcs_file.write(data)
+    if hasattr(data, 'read'):
+        for chunk in iter(lambda: data.read(WRITE_CHUNK_SIZE), b''):
+            gcs_file.write(chunk)
+    else:
+        gcs_file.write(data)
     gcs_file.close()
 
     return new_uuid
+
+
+def delete_expired(bucket_name=None, now=None, retry_params=None):
+    '''Deletes files written with `expires_in` whose expiry hour has passed.
+    Only the partitions under `EXPIRY_PREFIX` that are due get listed, so
+    the cost grows with the number of expired files, not the bucket size.
+    Meant to be run periodically, e.g. from a cron handler.
+
+      :param bucket_name: String of custom bucket name.
+      :param now: Unix timestamp to compare against, defaults to now.
+      :param retry_params: `RetryParams` object from `cloudstorage`
+
+      :returns: Integer, number of files deleted.
+    '''
+    if now is None:
+        now = time.time()
+    current = _expiry_partition(now)
+    retry_params = _retry_params(retry_params)
+    deleted = 0
+    partitions = gcs.listbucket(
+        get_gcs_filename(EXPIRY_PREFIX + '/', bucket_name),
+        delimiter='/', retry_params=retry_params)
+    for partition in partitions:
+        if not partition.is_dir:
+            continue
+        # partitions are listed in order, the rest are not due yet..
+        if partition.filename.rstrip('/').rsplit('/', 1)[-1] >= current:
+            break
+        for marker in gcs.listbucket(partition.filename,
+                                     retry_params=retry_params):
+            file_uuid = marker.filename.rsplit('/', 1)[-1]
+            try:
+                gcs.delete(get_gcs_filename(file_uuid, bucket_name),
+                           retry_params=retry_params)
+                deleted += 1
+            except gcs.NotFoundError:
+                pass
+            try:
+                gcs.delete(marker.filename, retry_params=retry_params)
+            except gcs.NotFoundError:
+                pass
+    return deleted
+
+
+def _copy_object(src, dst, name, force_download, options, retry_params,
+                 keep_expiry):
+    retry_params = _retry_params(retry_params)
+    if name is None and force_download is None and not options:
+        # plain server side copy, all headers and metadata are kept..
+        gcs.copy2(src, dst, retry_params=retry_params)
+        return
+    stats = gcs.stat(src, retry_params=retry_params)
+    metadata = dict(stats.metadata)
+    metadata['content-type'] = stats.content_type
+    if not keep_expiry:
+        metadata.pop(EXPIRY_METADATA_KEY, None)
+    if name is None:
+        name = metadata.get('x-goog-meta-filename')
+    if force_download is None:
+        force_download = metadata.get(FORCE_DOWNLOAD_METADATA_KEY) == 'true'
+    metadata.pop(FORCE_DOWNLOAD_METADATA_KEY, None)
+    metadata.update(_gcs_options(name, force_download))
+    metadata.update(options or {})
+    gcs.copy2(src, dst, metadata=metadata, retry_params=retry_params)
+
+
+def copy_file(file_uuid, bucket_name=None, dst_bucket_name=None, name=None,
+              force_download=None, options=None, retry_params=None):
+    '''Copies a file within Google Cloud Storage, without its data passing
+    through the instance, and returns the name of the copy.
+
+    Without `name`, `force_download` or `options` this is a single request
+    copying every header and all metadata as they are, including
+    `EXPIRY_METADATA_KEY`, which is inert on the copy as `delete_expired`
+    only acts on the markers of the original.
+
+    With overrides the metadata is replaced by what `gcs.stat` returns for
+    the source: the content type and the `x-goog-meta-` keys, without
+    `EXPIRY_METADATA_KEY`. Other headers such as `Cache-Control` or
+    `Content-Encoding` are dropped, and `Content-Disposition` is only kept
+    for files flagged with `FORCE_DOWNLOAD_METADATA_KEY`, so pass
+    `force_download` again for files written before that flag existed.
+
+      :param file_uuid: String, name of the file to copy.
+      :param bucket_name: String of custom bucket name of the file.
+      :param dst_bucket_name: String of custom bucket name for the copy,
+                              defaults to `bucket_name`.
+      :param name: String, new name of the data.
+      :param force_download: Boolean, whether or not the copy will be a
+                             forced download
+      :param options: Dict of extra headers or `x-goog-meta-` metadata.
+      :param retry_params: `RetryParams` object from `cloudstorage`
+
+      :returns: String, filename.
+    '''
+    if dst_bucket_name is None:
+        dst_bucket_name = bucket_name
+    new_uuid = str(uuid.uuid4())
+    _copy_object(get_gcs_filename(file_uuid, bucket_name),
+                 get_gcs_filename(new_uuid, dst_bucket_name),
+                 name, force_download, options, retry_params,
+                 keep_expiry=False)
+    return new_uuid
+
+
+def update_metadata(file_uuid, bucket_name=None, name=None,
+                    force_download=None, options=None, retry_params=None):
+    '''Rewrites the metadata of a file in place, by copying it onto
+    itself. Only the content type and the `x-goog-meta-` keys, including
+    the expiry, are kept, see `copy_file` for the headers that are lost.
+
+      :param file_uuid: String, name of the file.
+      :param bucket_name: String of custom bucket name.
+      :param name: String, new name of the data.
+      :param force_download: Boolean, whether or not file will be a forced
+                             download, defaults to keeping the current one
+                             for files flagged with
+                             `FORCE_DOWNLOAD_METADATA_KEY`.
+      :param options: Dict of extra headers or `x-goog-meta-` metadata.
+      :param retry_params: `RetryParams` object from `cloudstorage`
+    '''
+    if name is None and force_download is None and not options:
+        return
+    filename = get_gcs_filename(file_uuid, bucket_name)
+    _copy_object(filename, filename, name, force_download, options,
+                 retry_params, keep_expiry=True)
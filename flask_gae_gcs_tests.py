@@ -1,11 +1,14 @@
 #!/usr/bin/env python
 # coding: utf-8
+import time
 import uuid
 import unittest, logging
+from StringIO import StringIO
 from flask import json
 from flask import Flask
 from flask.ext import gae_tests
 from flask.ext import gae_gcs
+from werkzeug.datastructures import FileStorage
 from google.appengine.ext import ndb
 import cloudstorage as gcs
 
@@ -17,6 +20,7 @@ class TestModel(ndb.Model):
 app = Flask(__name__)
 app.debug = True
 app.request_class = gae_tests.FileUploadRequest
+app.config['GCS_CORS_MAX_AGE'] = 3600
 
 @app.route('/test_upload', methods=['POST', 'OPTIONS', 'HEAD', 'PUT'])
 @gae_gcs.upload_files()
@@ -39,6 +43,70 @@ def test_upload(uploads):
   return json.dumps(uploads.to_dict())
 
 
+@app.route('/test_upload_validated', methods=['POST'])
+@gae_gcs.upload_files(
+  validators=[gae_gcs.validate_min_size, gae_gcs.validate_max_size])
+def test_upload_validated(uploads):
+  return json.dumps(uploads.to_dict())
+
+
+@app.route('/test_upload_limited', methods=['POST'])
+@gae_gcs.upload_files(
+  admission=gae_gcs.UploadAdmissionController(files_per_minute=1))
+def test_upload_limited(uploads):
+  return json.dumps(uploads.to_dict())
+
+
+@app.route('/test_upload_bytes_limited', methods=['POST'])
+@gae_gcs.upload_files(
+  admission=gae_gcs.UploadAdmissionController(bytes_per_second=1,
+                                              bytes_burst=1))
+def test_upload_bytes_limited(uploads):
+  return json.dumps(uploads.to_dict())
+
+
+concurrent_admission = gae_gcs.UploadAdmissionController(max_concurrent=1)
+
+@app.route('/test_upload_failing', methods=['POST'])
+@gae_gcs.upload_files(admission=concurrent_admission)
+def test_upload_failing(uploads):
+  raise Exception('Upload handler failed..')
+
+
+cors_app = Flask('cors_app')
+cors_app.config['GCS_CORS_ORIGINS'] = ['http://allowed.example.com']
+
+@cors_app.route('/test_upload', methods=['POST', 'OPTIONS', 'HEAD'])
+@gae_gcs.upload_files()
+def test_cors_upload(uploads):
+  return json.dumps(uploads.to_dict())
+
+
+spooled_app = Flask('spooled_app')
+spooled_app.request_class = gae_gcs.UploadRequest
+spooled_app.config['GCS_SPOOL_MAX_MEMORY_SIZE'] = 1
+
+@spooled_app.route('/test_upload', methods=['POST'])
+@gae_gcs.upload_files()
+def test_spooled_upload(uploads):
+  return json.dumps(uploads.to_dict())
+
+
+class UnseekableStream(object):
+
+  def __init__(self, data):
+    self._stream = StringIO(data)
+
+  def read(self, *args):
+    return self._stream.read(*args)
+
+
+class FailingRateLimitBackend(gae_gcs.RateLimitBackend):
+
+  def consume(self, key, rate, capacity, amount, force=False):
+    raise Exception('Rate limit store unavailable..')
+
+
 # test cases..
 
 class TestCase(gae_tests.TestCase):
@@ -140,5 +208,285 @@ class TestCase(gae_tests.TestCase):
     self.assertIsInstance(results, list)
     self.assertEquals(1, len(results), results)
 
+  def test_spooled_upload_returns_valid_file_result(self):
+    data, filename, size = gae_tests.create_test_file('test.jpg')
+    response = spooled_app.test_client().post(
+      data={'test': (data, filename)},
+      path='/test_upload',
+      headers={},
+      query_string={})
+    self.assertEqual(200, response.status_code)
+    results = json.loads(response.data)
+    self.assertEquals(1, len(results), results)
+    self._assertUploadResult(results[0], filename, size)
+
+  def test_upload_with_several_validators_writes_whole_file(self):
+    data, filename, size = gae_tests.create_test_file('test.jpg')
+    response = app.test_client().post(
+      data={'test': (data, filename)},
+      path='/test_upload_validated',
+      headers={},
+      query_string={})
+    self.assertEqual(200, response.status_code)
+    results = json.loads(response.data)
+    self.assertEquals(1, len(results), results)
+    self._assertUploadResult(results[0], filename, size)
+
+  def test_upload_returns_valid_file_result_for_text_csv(self):
+    response = app.test_client().post(
+      data='a,b\n1,2\n',
+      path='/test_upload',
+      headers={'content-type': 'text/csv',
+               'content-disposition': 'attachment; filename="test.csv"'},
+      query_string={})
+    self.assertEqual(200, response.status_code)
+    results = json.loads(response.data)
+    self.assertEquals(1, len(results), results)
+    self._assertUploadResult(results[0], 'test.csv', len('a,b\n1,2\n'))
+
+  def test_save_files_sizes_unseekable_stream(self):
+    field = FileStorage(stream=UnseekableStream('test blob data..'),
+                        filename='test.txt',
+                        content_type='text/plain')
+    results = gae_gcs.save_files([('file', field)])
+    self.assertEquals(1, len(results))
+    self.assertTrue(results[0].successful)
+    self.assertEquals(len('test blob data..'), results[0].size)
+    file_info = gcs.stat(gae_gcs.get_gcs_filename(results[0].uuid))
+    self.assertEquals(len('test blob data..'), file_info.st_size)
+
+  def test_expired_files_are_deleted(self):
+    file_uuid = gae_gcs.write_to_gcs(
+      'test blob data..', 'text/plain', name='test.txt', expires_in=60)
+    bucket_filename = gae_gcs.get_gcs_filename(file_uuid)
+    stats = gcs.stat(bucket_filename)
+    self.assertTrue(int(stats.metadata[gae_gcs.EXPIRY_METADATA_KEY]) > 0)
+    # still in the current partition..
+    self.assertEquals(0, gae_gcs.delete_expired())
+    self.assertEquals(1, gae_gcs.delete_expired(now=time.time() + 7200))
+    self.assertRaises(gcs.NotFoundError, gcs.stat, bucket_filename)
+    self.assertEquals(0, gae_gcs.delete_expired(now=time.time() + 7200))
+
+  def test_delete_expired_skips_already_deleted_files(self):
+    file_uuid = gae_gcs.write_to_gcs(
+      'test blob data..', 'text/plain', name='test.txt', expires_in=60)
+    gcs.delete(gae_gcs.get_gcs_filename(file_uuid))
+    self.assertEquals(0, gae_gcs.delete_expired(now=time.time() + 7200))
+
+  def test_copy_file_keeps_filename(self):
+    file_uuid = gae_gcs.write_to_gcs(
+      'test blob data..', 'text/plain', name='test.txt')
+    copy_uuid = gae_gcs.copy_file(file_uuid)
+    self.assertNotEquals(file_uuid, copy_uuid)
+    stats = gcs.stat(gae_gcs.get_gcs_filename(copy_uuid))
+    self.assertEquals('test.txt', stats.metadata['x-goog-meta-filename'])
+    self.assertEquals('text/plain', stats.content_type)
+    self.assertEquals(len('test blob data..'), stats.st_size)
+
+  def test_copy_file_stays_in_source_bucket(self):
+    file_uuid = gae_gcs.write_to_gcs(
+      'test blob data..', 'text/plain', name='test.txt',
+      bucket_name='custom-bucket')
+    copy_uuid = gae_gcs.copy_file(file_uuid, bucket_name='custom-bucket')
+    stats = gcs.stat(gae_gcs.get_gcs_filename(copy_uuid, 'custom-bucket'))
+    self.assertEquals(len('test blob data..'), stats.st_size)
+    self.assertRaises(gcs.NotFoundError, gcs.stat,
+                      gae_gcs.get_gcs_filename(copy_uuid))
+
+  def test_copy_file_keeps_inert_expiry(self):
+    file_uuid = gae_gcs.write_to_gcs(
+      'test blob data..', 'text/plain', name='test.txt', expires_in=60)
+    copy_uuid = gae_gcs.copy_file(file_uuid)
+    copy_filename = gae_gcs.get_gcs_filename(copy_uuid)
+    stats = gcs.stat(copy_filename)
+    self.assertIn(gae_gcs.EXPIRY_METADATA_KEY, stats.metadata)
+    # only the original has a marker..
+    self.assertEquals(1, gae_gcs.delete_expired(now=time.time() + 7200))
+    self.assertEquals('test.txt',
+                      gcs.stat(copy_filename).metadata['x-goog-meta-filename'])
+
+  def test_copy_file_with_overrides_drops_expiry(self):
+    file_uuid = gae_gcs.write_to_gcs(
+      'test blob data..', 'text/plain', name='test.txt', expires_in=60)
+    copy_uuid = gae_gcs.copy_file(file_uuid, name='copy.txt')
+    stats = gcs.stat(gae_gcs.get_gcs_filename(copy_uuid))
+    self.assertNotIn(gae_gcs.EXPIRY_METADATA_KEY, stats.metadata)
+    self.assertEquals('copy.txt', stats.metadata['x-goog-meta-filename'])
+
+  def test_update_metadata_renames_file(self):
+    file_uuid = gae_gcs.write_to_gcs(
+      'test blob data..', 'text/plain', name='test.txt')
+    gae_gcs.update_metadata(file_uuid, name='renamed.txt',
+                            force_download=True)
+    stats = gcs.stat(gae_gcs.get_gcs_filename(file_uuid))
+    self.assertEquals('renamed.txt', stats.metadata['x-goog-meta-filename'])
+    self.assertEquals(
+      'true', stats.metadata[gae_gcs.FORCE_DOWNLOAD_METADATA_KEY])
+    self.assertEquals('text/plain', stats.content_type)
+
+  def test_update_metadata_keeps_forced_download(self):
+    file_uuid = gae_gcs.write_to_gcs(
+      'test blob data..', 'text/plain', name='test.txt',
+      force_download=True)
+    gae_gcs.update_metadata(file_uuid, name='renamed.txt')
+    stats = gcs.stat(gae_gcs.get_gcs_filename(file_uuid))
+    self.assertEquals('renamed.txt', stats.metadata['x-goog-meta-filename'])
+    self.assertEquals(
+      'true', stats.metadata[gae_gcs.FORCE_DOWNLOAD_METADATA_KEY])
+    gae_gcs.update_metadata(file_uuid, force_download=False)
+    stats = gcs.stat(gae_gcs.get_gcs_filename(file_uuid))
+    self.assertNotIn(gae_gcs.FORCE_DOWNLOAD_METADATA_KEY, stats.metadata)
+
+  def test_update_metadata_on_unflagged_forced_download(self):
+    # written before FORCE_DOWNLOAD_METADATA_KEY existed..
+    file_uuid = str(uuid.uuid4())
+    bucket_filename = gae_gcs.get_gcs_filename(file_uuid)
+    gcs_file = gcs.open(bucket_filename,
+                        'w',
+                        content_type='text/plain',
+                        options={
+                          'x-goog-meta-filename': 'test.txt',
+                          'Content-Disposition':
+                            'attachment; filename=test.txt'
+                        })
+    gcs_file.write('test blob data..')
+    gcs_file.close()
+    # the disposition can't be read back, so it is only kept when passed..
+    gae_gcs.update_metadata(file_uuid, name='renamed.txt')
+    stats = gcs.stat(bucket_filename)
+    self.assertEquals('renamed.txt', stats.metadata['x-goog-meta-filename'])
+    self.assertNotIn(gae_gcs.FORCE_DOWNLOAD_METADATA_KEY, stats.metadata)
+    gae_gcs.update_metadata(file_uuid, force_download=True)
+    stats = gcs.stat(bucket_filename)
+    self.assertEquals(
+      'true', stats.metadata[gae_gcs.FORCE_DOWNLOAD_METADATA_KEY])
+
+  def test_preflight_skips_upload(self):
+    response = app.test_client().open(
+      method='OPTIONS',
+      path='/test_upload',
+      headers={'Origin': 'http://example.com'},
+      query_string={})
+    self.assertEqual(200, response.status_code)
+    self.assertEqual('', response.data)
+    self.assertEqual('*', response.headers['Access-Control-Allow-Origin'])
+    self.assertEqual(', '.join(gae_gcs.OPTIONS),
+                     response.headers['Access-Control-Allow-Methods'])
+    self.assertEqual('3600', response.headers['Access-Control-Max-Age'])
+
+  def test_head_skips_upload(self):
+    response = app.test_client().open(
+      method='HEAD',
+      path='/test_upload',
+      headers={},
+      query_string={})
+    self.assertEqual(200, response.status_code)
+    self.assertEqual('', response.data)
+    self.assertEqual('3600', response.headers['Access-Control-Max-Age'])
+
+  def test_preflight_echoes_allowed_origin(self):
+    response = cors_app.test_client().open(
+      method='OPTIONS',
+      path='/test_upload',
+      headers={'Origin': 'http://allowed.example.com'},
+      query_string={})
+    self.assertEqual(200, response.status_code)
+    self.assertEqual('http://allowed.example.com',
+                     response.headers['Access-Control-Allow-Origin'])
+    self.assertEqual('Origin', response.headers['Vary'])
+    self.assertNotIn('Access-Control-Max-Age', response.headers)
+
+  def test_preflight_omits_disallowed_origin(self):
+    response = cors_app.test_client().open(
+      method='OPTIONS',
+      path='/test_upload',
+      headers={'Origin': 'http://other.example.com'},
+      query_string={})
+    self.assertEqual(200, response.status_code)
+    self.assertNotIn('Access-Control-Allow-Origin', response.headers)
+    self.assertEqual('Origin', response.headers['Vary'])
+
+  def test_upload_over_rate_limit_returns_429(self):
+    client = app.test_client()
+    data, filename, size = gae_tests.create_test_file('test.jpg')
+    response = client.post(
+      data={'test': (data, filename)},
+      path='/test_upload_limited',
+      headers={},
+      query_string={})
+    self.assertEqual(200, response.status_code)
+    data, filename, size = gae_tests.create_test_file('test.jpg')
+    response = client.post(
+      data={'test': (data, filename)},
+      path='/test_upload_limited',
+      headers={},
+      query_string={})
+    self.assertEqual(429, response.status_code)
+    self.assertTrue(int(response.headers['Retry-After']) > 0)
+    self.assertEqual(gae_gcs.MSG_TOO_MANY_REQUESTS,
+                     json.loads(response.data)['error_msg'])
+
+  def test_upload_over_byte_limit_returns_429(self):
+    client = app.test_client()
+    data, filename, size = gae_tests.create_test_file('test.jpg')
+    response = client.post(
+      data={'test': (data, filename)},
+      path='/test_upload_bytes_limited',
+      headers={},
+      query_string={})
+    self.assertEqual(200, response.status_code)
+    data, filename, size = gae_tests.create_test_file('test.jpg')
+    response = client.post(
+      data={'test': (data, filename)},
+      path='/test_upload_bytes_limited',
+      headers={},
+      query_string={})
+    self.assertEqual(429, response.status_code)
+    self.assertTrue(int(response.headers['Retry-After']) > 1)
+
+  def test_upload_over_concurrency_limit_is_not_charged(self):
+    admission = gae_gcs.UploadAdmissionController(
+      files_per_minute=2, max_concurrent=1)
+    with app.test_request_context('/test_upload', method='POST'):
+      self.assertEqual(None, admission.admit())
+      self.assertEqual(429, admission.admit().status_code)
+      admission.release()
+      # the rejected request didn't take the second file token..
+      self.assertEqual(None, admission.admit())
+      admission.release()
+
+  def test_admit_releases_slot_when_backend_fails(self):
+    admission = gae_gcs.UploadAdmissionController(
+      files_per_minute=1, max_concurrent=1,
+      backend=FailingRateLimitBackend())
+    with app.test_request_context('/test_upload', method='POST'):
+      self.assertRaises(Exception, admission.admit)
+      admission.backend = gae_gcs.MemoryRateLimitBackend()
+      self.assertEqual(None, admission.admit())
+      admission.release()
+
+  def test_memory_backend_keeps_draining_buckets(self):
+    backend = gae_gcs.MemoryRateLimitBackend(max_keys=1)
+    self.assertEqual(0, backend.consume('a', 0.001, 10, 10))
+    # over max_keys, but 'a' hasn't refilled so must not be reset..
+    self.assertEqual(0, backend.consume('b', 0.001, 10, 1))
+    self.assertTrue(backend.consume('a', 0.001, 10, 1) > 0)
+    # refilled buckets are dropped..
+    self.assertEqual(0, backend.consume('c', 1000, 10, 1))
+    time.sleep(0.05)
+    self.assertEqual(0, backend.consume('d', 1000, 10, 1))
+    self.assertNotIn('c', backend._buckets)
+
+  def test_upload_releases_slot_when_handler_fails(self):
+    data, filename, size = gae_tests.create_test_file('test.jpg')
+    self.assertRaises(Exception, app.test_client().post,
+      data={'test': (data, filename)},
+      path='/test_upload_failing',
+      headers={},
+      query_string={})
+    with app.test_request_context('/test_upload_failing', method='POST'):
+      self.assertEqual(None, concurrent_admission.admit())
+      concurrent_admission.release()
+
 if __name__ == '__main__':
   unittest.main()